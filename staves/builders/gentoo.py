@@ -1,3 +1,6 @@
+import collections
+import fcntl
+import functools
 import glob
 import json
 import logging
@@ -6,11 +9,16 @@ import os
 import shutil
 import struct
 import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
 
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field, replace
 from pathlib import Path
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 from typing import (
+    IO,
     Mapping,
     NewType,
     Optional,
@@ -33,6 +41,7 @@ class Libc(Enum):
 class BuilderConfig:
     libc: Libc
     concurrent_jobs: int = None
+    image_id: Optional[str] = None
 
 
 class StavesError(Exception):
@@ -52,16 +61,67 @@ class PackagingConfig:
 
 
 def _create_rootfs(
-    rootfs_path, *packages, max_concurrent_jobs: int = 1, max_cpu_load: int = 1
+    rootfs_path,
+    *packages,
+    max_concurrent_jobs: int = 1,
+    max_cpu_load: int = 1,
+    update: bool = False,
 ):
     logger.info(
         "Creating rootfs at {} containing the following packages:".format(rootfs_path)
     )
     logger.info(", ".join(packages))
 
-    logger.debug("Installing build-time dependencies to builder")
     emerge_env = os.environ
     emerge_env["MAKEOPTS"] = "-j{} -l{}".format(max_concurrent_jobs, max_cpu_load)
+    with tempfile.TemporaryFile() as prefetch_log:
+        prefetch = _prefetch_distfiles(*packages, env=emerge_env, log=prefetch_log)
+        try:
+            _install_packages(
+                rootfs_path,
+                *packages,
+                env=emerge_env,
+                max_concurrent_jobs=max_concurrent_jobs,
+                max_cpu_load=max_cpu_load,
+                update=update,
+            )
+        except BaseException:
+            prefetch.terminate()
+            raise
+        finally:
+            if prefetch.wait() > 0:
+                prefetch_log.seek(0)
+                logger.warning(prefetch_log.read().decode(errors="replace"))
+                logger.warning("Prefetching distfiles failed.")
+
+
+def _prefetch_distfiles(*packages, env: Mapping[str, str], log) -> subprocess.Popen:
+    # Fetches the sources of all packages that are not available as binary packages
+    # in the background. Portage locks distfiles, so concurrent emerge calls wait for
+    # a running download instead of fetching the same file again.
+    logger.debug("Prefetching distfiles")
+    emerge_fetch_command = [
+        "emerge",
+        "--fetchonly",
+        "--usepkg",
+        "--with-bdeps=y",
+        "--emptytree",
+        *packages,
+    ]
+    return subprocess.Popen(
+        emerge_fetch_command, stdout=subprocess.DEVNULL, stderr=log, env=env
+    )
+
+
+def _install_packages(
+    rootfs_path,
+    *packages,
+    env: Mapping[str, str],
+    max_concurrent_jobs: int,
+    max_cpu_load: int,
+    update: bool,
+):
+    logger.debug("Installing build-time dependencies to builder")
     # --emptytree is needed, because build dependencies of runtime dependencies are ignored by --root-deps=rdeps
     # (even when --with-bdeps=y is passed). By adding --emptytree, we get a binary package that can be installed to rootfs
     emerge_bdeps_command = [
@@ -78,7 +138,7 @@ def _create_rootfs(
         *packages,
     ]
     emerge_bdeps_call = subprocess.run(
-        emerge_bdeps_command, stderr=subprocess.PIPE, env=emerge_env
+        emerge_bdeps_command, stderr=subprocess.PIPE, env=env
     )
     if emerge_bdeps_call.returncode != 0:
         logger.error(emerge_bdeps_call.stderr)
@@ -92,6 +152,7 @@ def _create_rootfs(
         "--root-deps=rdeps",
         "--oneshot",
         "--usepkg",
+        *(["--update", "--deep"] if update else []),
         "--jobs",
         str(max_concurrent_jobs),
         "--load-average",
@@ -99,11 +160,88 @@ def _create_rootfs(
         *packages,
     ]
     emerge_rdeps_call = subprocess.run(
-        emerge_rdeps_command, stderr=subprocess.PIPE, env=emerge_env
+        emerge_rdeps_command, stderr=subprocess.PIPE, env=env
     )
     if emerge_rdeps_call.returncode != 0:
         logger.error(emerge_rdeps_call.stderr)
         raise RootfsError("Unable to install runtime dependencies.")
+    if update:
+        _depclean_rootfs(rootfs_path, *packages, env=env)
+
+
+def _depclean_rootfs(rootfs_path, *packages, env: Mapping[str, str]):
+    # Packages are installed with --oneshot, so the rootfs has no world file.
+    # A temporary world file restricts depclean to the packages of the image spec
+    # and removes dependencies that upgraded packages no longer require.
+    logger.debug("Removing unneeded packages from rootfs")
+    world_path = Path(rootfs_path) / "var" / "lib" / "portage" / "world"
+    world_path.parent.mkdir(parents=True, exist_ok=True)
+    world_path.write_text("".join(package + os.linesep for package in packages))
+    try:
+        emerge_depclean_call = subprocess.run(
+            [
+                "emerge",
+                "--verbose",
+                "--root={}".format(rootfs_path),
+                "--depclean",
+                "--with-bdeps=n",
+            ],
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+    finally:
+        world_path.unlink()
+    if emerge_depclean_call.returncode != 0:
+        logger.error(emerge_depclean_call.stderr)
+        raise RootfsError("Unable to remove unneeded packages from rootfs.")
+
+
+distfiles_dir = "/var/cache/distfiles"
+_distfiles_lock_name = ".staves.lock"
+_stale_download_age = 24 * 60 * 60
+
+
+def _lock_distfiles(distfiles_path: str = distfiles_dir) -> IO:
+    # Every build holds a shared lock on the distfiles cache, which may be shared
+    # by concurrent builds. Distfiles are only evicted under an exclusive lock.
+    os.makedirs(distfiles_path, exist_ok=True)
+    lock_file = open(os.path.join(distfiles_path, _distfiles_lock_name), "a")
+    fcntl.flock(lock_file, fcntl.LOCK_SH)
+    return lock_file
+
+
+def _evict_distfiles(max_size: int, distfiles_path: str = distfiles_dir):
+    with open(os.path.join(distfiles_path, _distfiles_lock_name), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Distfiles cache is in use by another build. Skipping eviction")
+            return
+        logger.debug(f"Evicting distfiles exceeding {max_size} bytes")
+        distfiles = []
+        for entry in os.scandir(distfiles_path):
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            if entry.name == _distfiles_lock_name:
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            # Downloads may still be in progress, unless they are stale
+            if entry.name.endswith(".__download__"):
+                if time.time() - stat.st_mtime > _stale_download_age:
+                    os.remove(entry.path)
+                continue
+            # Leftovers of failed checksum verifications will never be reused
+            if "._checksum_failure_." in entry.name:
+                os.remove(entry.path)
+                continue
+            last_used = max(stat.st_atime, stat.st_mtime)
+            distfiles.append((last_used, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in distfiles)
+        for _, size, path in sorted(distfiles):
+            if total_size <= max_size:
+                break
+            os.remove(path)
+            total_size -= size
 
 
 def _max_cpu_load() -> int:
@@ -114,45 +252,176 @@ def _max_concurrent_jobs() -> int:
     return _max_cpu_load() + 1
 
 
-def _copy_stdlib(rootfs_path: str, copy_libstdcpp: bool):
-    libgcc = "libgcc_s.so.1"
-    libstdcpp = "libstdc++.so.6"
-    search_path = os.path.join("/usr", "lib", "gcc")
-    libgcc_path = None
-    libstdcpp_path = None
-    for directory_path, subdirs, files in os.walk(search_path):
-        if libgcc in files:
-            libgcc_path = os.path.join(directory_path, libgcc)
-        if libstdcpp in files:
-            libstdcpp_path = os.path.join(directory_path, libstdcpp)
-    if libgcc_path is None:
-        raise StavesError("Unable to find " + libgcc + " in " + search_path)
-    shutil.copy(libgcc_path, os.path.join(rootfs_path, "usr", "lib"))
-    if copy_libstdcpp:
-        if libstdcpp_path is None:
-            raise StavesError("Unable to find " + libstdcpp + " in " + search_path)
-        shutil.copy(libstdcpp_path, os.path.join(rootfs_path, "usr", "lib"))
+@functools.lru_cache()
+def _compiler_runtime_index() -> Mapping[str, str]:
+    # gcc-config registers the library directory of the active compiler
+    # in ld.so.conf.d, so there is no need to search all of /usr/lib/gcc
+    library_dirs = []
+    for ld_conf_path in sorted(glob.glob("/etc/ld.so.conf.d/*gcc*.conf")):
+        with open(ld_conf_path) as ld_conf:
+            library_dirs += [
+                line.strip()
+                for line in ld_conf
+                if line.strip() and not line.startswith("#")
+            ]
+    index = {}
+    for library_dir in library_dirs:
+        if not os.path.isdir(library_dir):
+            continue
+        for library in os.listdir(library_dir):
+            index.setdefault(library, os.path.join(library_dir, library))
+    return index
+
+
+def _find_compiler_runtime(library: str) -> str:
+    library_path = _compiler_runtime_index().get(library)
+    if library_path is not None:
+        return library_path
+    gcc_call = subprocess.run(
+        ["gcc", f"-print-file-name={library}"],
+        universal_newlines=True,
+        stdout=subprocess.PIPE,
+    )
+    # gcc prints the bare library name if it cannot find the library
+    library_path = gcc_call.stdout.strip()
+    if gcc_call.returncode != 0 or not os.path.isabs(library_path):
+        raise StavesError(f"Unable to find {library} in the GCC library directories")
+    return library_path
 
 
-def _copy_to_rootfs(rootfs: str, path_glob: str):
-    globs = glob.iglob(path_glob)
-    for host_path in globs:
-        rootfs_path = os.path.join(rootfs, os.path.relpath(host_path, "/"))
-        os.makedirs(os.path.dirname(rootfs_path), exist_ok=True)
-        if os.path.islink(
-            host_path
-        ):  # Needs to be checked first, because other methods follow links
-            link_target = os.readlink(host_path)
-            os.symlink(link_target, rootfs_path)
-        elif os.path.isdir(host_path):
-            shutil.copytree(host_path, rootfs_path)
-        elif os.path.isfile(host_path):
-            shutil.copy(host_path, rootfs_path)
+def _stdlib_paths(copy_libstdcpp: bool) -> Mapping[str, str]:
+    libraries = ["libgcc_s.so.1"]
+    if copy_libstdcpp:
+        libraries.append("libstdc++.so.6")
+    # The runtime libraries in the GCC library directory are usually symlinks
+    # to versioned files, so the link target is copied to the soname instead
+    return {
+        os.path.realpath(_find_compiler_runtime(library)): os.path.join(
+            "/usr", "lib", library
+        )
+        for library in libraries
+    }
+
+
+_FICLONE = 0x40049409
+
+
+def _copy_file_contents(source: IO, destination: IO):
+    try:
+        # Creates a reflink on file systems supporting copy-on-write, e.g. Btrfs or XFS
+        fcntl.ioctl(destination.fileno(), _FICLONE, source.fileno())
+        return
+    except OSError:
+        pass
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        size = os.fstat(source.fileno()).st_size
+        try:
+            while copied < size:
+                chunk_size = os.copy_file_range(
+                    source.fileno(), destination.fileno(), size - copied
+                )
+                if chunk_size == 0:
+                    break
+                copied += chunk_size
+            return
+        except OSError:
+            if copied:
+                raise
+    shutil.copyfileobj(source, destination)
+
+
+def _remove_existing(path: str):
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+
+
+def _copy_file(source: str, destination: str):
+    _remove_existing(destination)
+    with open(source, "rb") as source_file, open(destination, "wb") as dest_file:
+        _copy_file_contents(source_file, dest_file)
+    shutil.copystat(source, destination)
+
+
+def _copy_to_rootfs(
+    rootfs: str,
+    *path_globs: str,
+    path_mapping: Mapping[str, str] = None,
+    max_workers: int = None,
+):
+    """Copies host paths into rootfs preserving symlinks and hardlinks.
+
+    Paths matching any of path_globs are copied to the same location in rootfs.
+    path_mapping maps additional host paths to their location in rootfs.
+    """
+    destinations = dict(path_mapping or {})
+    for path_glob in path_globs:
+        host_paths = glob.glob(path_glob)
+        if not host_paths:
+            raise StavesError("{} does not match any files.".format(path_glob))
+        for host_path in host_paths:
+            destinations[host_path] = host_path
+    directories = []
+    symlinks = []
+    files = {}
+    hardlinks = []
+    staged_paths = set()
+
+    def add(host_path: str, rootfs_path: str):
+        # Overlapping globs reach the same paths more than once
+        rootfs_path = os.path.normpath(rootfs_path)
+        if rootfs_path in staged_paths:
+            return
+        staged_paths.add(rootfs_path)
+        stat = os.lstat(host_path)
+        if S_ISLNK(stat.st_mode):
+            symlinks.append((os.readlink(host_path), rootfs_path))
+        elif S_ISDIR(stat.st_mode):
+            directories.append((host_path, rootfs_path))
+        elif S_ISREG(stat.st_mode):
+            inode = (stat.st_dev, stat.st_ino)
+            if inode not in files:
+                files[inode] = (host_path, rootfs_path)
+            elif files[inode][1] != rootfs_path:
+                hardlinks.append((files[inode][1], rootfs_path))
         else:
             raise StavesError(
-                "Copying {} to rootfs is not supported.".format(path_glob)
+                "Copying {} to rootfs is not supported.".format(host_path)
             )
 
+    for host_path, destination in destinations.items():
+        rootfs_path = os.path.join(rootfs, os.path.relpath(destination, "/"))
+        add(host_path, rootfs_path)
+        if not os.path.isdir(host_path) or os.path.islink(host_path):
+            continue
+        for directory_path, subdirs, filenames in os.walk(host_path):
+            relative_directory = os.path.relpath(directory_path, host_path)
+            for name in subdirs + filenames:
+                add(
+                    os.path.join(directory_path, name),
+                    os.path.normpath(
+                        os.path.join(rootfs_path, relative_directory, name)
+                    ),
+                )
+
+    for _, rootfs_path in [*directories, *symlinks, *files.values(), *hardlinks]:
+        os.makedirs(os.path.dirname(rootfs_path), exist_ok=True)
+    for _, rootfs_path in directories:
+        os.makedirs(rootfs_path, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in executor.map(lambda paths: _copy_file(*paths), files.values()):
+            pass
+    for link_source, rootfs_path in hardlinks:
+        _remove_existing(rootfs_path)
+        os.link(link_source, rootfs_path)
+    for link_target, rootfs_path in symlinks:
+        _remove_existing(rootfs_path)
+        os.symlink(link_target, rootfs_path)
+    # Children are processed first, so that copying their contents
+    # does not alter the timestamps of the parent directory
+    for host_path, rootfs_path in reversed(directories):
+        shutil.copystat(host_path, rootfs_path)
+
 
 @dataclass
 class Locale:
@@ -248,14 +517,144 @@ class ImageSpec:
     repositories: Sequence[Repository] = field(default_factory=list)
     package_configs: Mapping[str, Mapping] = field(default_factory=dict)
     packages_to_be_installed: Sequence[str] = field(default_factory=list)
+    files_to_be_copied: Sequence[str] = field(default_factory=list)
+
+
+ccache_dir = "/var/cache/ccache"
+# The statistics in CCACHE_DIR are shared by all builds using the cache volume.
+# A stats log outside of the volume records the results of this build only.
+ccache_stats_log = "/var/tmp/staves/ccache-stats.log"
+
+
+def _enable_ccache(build_env: BuildEnvironment, max_size: str):
+    if shutil.which("ccache") is None:
+        logger.info("Installing ccache to builder")
+        run_and_log_error(
+            ["emerge", "--oneshot", "--usepkg", "--noreplace", "dev-util/ccache"]
+        )
+    os.makedirs(os.path.dirname(ccache_stats_log), exist_ok=True)
+    build_env.write_env(
+        {
+            "FEATURES": "${FEATURES} ccache",
+            "CCACHE_DIR": ccache_dir,
+            "CCACHE_SIZE": max_size,
+            "CCACHE_STATSLOG": ccache_stats_log,
+        }
+    )
+    os.environ["CCACHE_DIR"] = ccache_dir
+    run_and_log_error(["ccache", "--max-size", max_size])
+
+
+def _log_ccache_stats(stats_log_path: str = ccache_stats_log):
+    if not os.path.exists(stats_log_path):
+        logger.info("ccache statistics: no compiler invocations were recorded")
+        return
+    # The stats log contains a comment line with the source file of each
+    # compilation followed by the names of the updated counters
+    with open(stats_log_path) as stats_log:
+        counters = collections.Counter(
+            line.strip() for line in stats_log if line.strip() and line[0] != "#"
+        )
+    hits = counters["direct_cache_hit"] + counters["preprocessed_cache_hit"]
+    misses = counters["cache_miss"]
+    compilations = hits + misses
+    hit_rate = 100 * hits / compilations if compilations else 0
+    logger.info(
+        f"ccache statistics: hits: {hits}, misses: {misses}, hit rate: {hit_rate:.1f}%"
+    )
+
+
+rootfs_cache_root = Path("/var/cache/staves/rootfs")
+
+
+def _rootfs_manifest(
+    image_spec: ImageSpec, config: BuilderConfig, stdlib: bool
+) -> Mapping:
+    return dict(
+        image_spec=asdict(image_spec),
+        libc=config.libc.name,
+        profile=os.path.realpath("/etc/portage/make.profile"),
+        builder=config.image_id,
+        stdlib=stdlib,
+    )
+
+
+def _is_incremental_update_safe(previous: Mapping, current: Mapping) -> bool:
+    # Manifests written in a different format cannot be compared reliably
+    if not isinstance(previous, Mapping) or previous.keys() != current.keys():
+        return False
+    if {**previous, "image_spec": None} != {**current, "image_spec": None}:
+        return False
+    try:
+        previous_spec = _deserialize_image_spec(json.dumps(previous["image_spec"]))
+    except (KeyError, TypeError, ValueError):
+        return False
+    current_spec = _deserialize_image_spec(json.dumps(current["image_spec"]))
+    if replace(previous_spec, packages_to_be_installed=[]) != replace(
+        current_spec, packages_to_be_installed=[]
+    ):
+        return False
+    return set(previous_spec.packages_to_be_installed) <= set(
+        current_spec.packages_to_be_installed
+    )
+
+
+def _restore_rootfs(lineage: str, rootfs_path: str, manifest: Mapping) -> bool:
+    cache_path = rootfs_cache_root / lineage
+    manifest_path = cache_path / "manifest.json"
+    if not manifest_path.exists():
+        logger.info(f"No cached rootfs found for {lineage}. Performing a full build")
+        return False
+    try:
+        previous_manifest = json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        logger.warning(f"Unable to read the cached rootfs manifest of {lineage}")
+        previous_manifest = None
+    if not _is_incremental_update_safe(previous_manifest, manifest):
+        logger.info(
+            f"Image spec of {lineage} changed in ways other than adding packages. "
+            "Performing a full build"
+        )
+        return False
+    logger.info(f"Updating cached rootfs of {lineage}")
+    try:
+        run_and_log_error(["cp", "-a", str(cache_path / "rootfs"), rootfs_path])
+    except StavesError:
+        logger.warning(
+            f"Unable to restore the cached rootfs of {lineage}. Performing a full build"
+        )
+        shutil.rmtree(rootfs_path, ignore_errors=True)
+        return False
+    return True
+
+
+def _store_rootfs(lineage: str, rootfs_path: str, manifest: Mapping):
+    cache_path = rootfs_cache_root / lineage
+    staging_path = cache_path.with_name(cache_path.name + ".new")
+    previous_path = cache_path.with_name(cache_path.name + ".old")
+    for path in (staging_path, previous_path):
+        if path.exists():
+            shutil.rmtree(path)
+    staging_path.mkdir(parents=True)
+    run_and_log_error(["cp", "-a", rootfs_path, str(staging_path / "rootfs")])
+    (staging_path / "manifest.json").write_text(json.dumps(manifest))
+    if cache_path.exists():
+        cache_path.rename(previous_path)
+    staging_path.rename(cache_path)
+    if previous_path.exists():
+        shutil.rmtree(previous_path)
 
 
 def build(
     image_spec: ImageSpec,
     config: BuilderConfig,
     stdlib: bool,
+    rootfs_cache: Optional[str] = None,
+    distfiles_cache_size: Optional[int] = None,
+    ccache_size: Optional[str] = None,
 ):
     rootfs_path = "/tmp/rootfs"
+    distfiles_lock = _lock_distfiles()
     build_env = BuildEnvironment()
     build_env.write_env(
         {
@@ -266,6 +665,8 @@ def build(
             "PORTAGE_ELOG_SYSTEM": "echo:warn,error",
         }
     )
+    if ccache_size is not None:
+        _enable_ccache(build_env, ccache_size)
     if image_spec.global_env:
         build_env.write_env(image_spec.global_env)
     if image_spec.package_envs:
@@ -279,20 +680,49 @@ def build(
     packages = list(image_spec.packages_to_be_installed)
     packages.append("virtual/libc")
     concurrent_jobs = config.concurrent_jobs or _max_concurrent_jobs()
-    _create_rootfs(
-        rootfs_path,
-        *packages,
-        max_concurrent_jobs=concurrent_jobs,
-        max_cpu_load=_max_cpu_load(),
+    manifest = _rootfs_manifest(image_spec, config, stdlib)
+    update = rootfs_cache is not None and _restore_rootfs(
+        rootfs_cache, rootfs_path, manifest
     )
-    _copy_stdlib(rootfs_path, copy_libstdcpp=stdlib)
+    try:
+        _create_rootfs(
+            rootfs_path,
+            *packages,
+            max_concurrent_jobs=concurrent_jobs,
+            max_cpu_load=_max_cpu_load(),
+            update=update,
+        )
+    except RootfsError:
+        if not update:
+            raise
+        logger.warning("Updating the cached rootfs failed. Performing a full build")
+        shutil.rmtree(rootfs_path)
+        _create_rootfs(
+            rootfs_path,
+            *packages,
+            max_concurrent_jobs=concurrent_jobs,
+            max_cpu_load=_max_cpu_load(),
+        )
+    if ccache_size is not None:
+        _log_ccache_stats()
+    path_globs = list(image_spec.files_to_be_copied)
     if config.libc == Libc.glibc:
         with open(os.path.join("/etc", "locale.gen"), "a") as locale_conf:
             locale_conf.writelines(
                 "{} {}".format(image_spec.locale.name, image_spec.locale.charset)
             )
             subprocess.run("locale-gen")
-        _copy_to_rootfs(rootfs_path, "/usr/lib/locale/locale-archive")
+        path_globs.append("/usr/lib/locale/locale-archive")
+    _copy_to_rootfs(
+        rootfs_path,
+        *path_globs,
+        path_mapping=_stdlib_paths(copy_libstdcpp=stdlib),
+    )
+    if rootfs_cache is not None:
+        _store_rootfs(rootfs_cache, rootfs_path, manifest)
+    distfiles_lock.close()
+    if distfiles_cache_size is not None:
+        _evict_distfiles(max_size=distfiles_cache_size * 1024 * 1024)
 
 
 def _deserialize_image_spec(data: bytes) -> ImageSpec:
@@ -306,13 +736,27 @@ def _deserialize_image_spec(data: bytes) -> ImageSpec:
         ],
         package_configs=image_spec_json["package_configs"],
         packages_to_be_installed=image_spec_json["packages_to_be_installed"],
+        files_to_be_copied=image_spec_json.get("files_to_be_copied", []),
     )
 
 
+def _configure_logging(stream: IO) -> logging.Handler:
+    # The builder runs as a standalone script. Without a handler, Python only
+    # emits warnings and errors, which would hide the progress reports of the build.
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    return handler
+
+
 if __name__ == "__main__":
     import argparse
     import sys
 
+    _configure_logging(sys.stdout)
+
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--stdlib",
@@ -326,6 +770,26 @@ if __name__ == "__main__":
         action="store_false",
         help="Do not copy stdlib into target image",
     )
+    parser.add_argument(
+        "--rootfs-cache",
+        metavar="LINEAGE",
+        help="Reuse and update the cached rootfs of the specified image lineage",
+    )
+    parser.add_argument(
+        "--builder-id",
+        help="Image ID of the builder, used to invalidate the cached rootfs",
+    )
+    parser.add_argument(
+        "--distfiles-cache-size",
+        type=int,
+        metavar="MIB",
+        help="Evict the least recently used distfiles exceeding the specified size",
+    )
+    parser.add_argument(
+        "--ccache-size",
+        metavar="SIZE",
+        help="Compile with ccache limiting the cache to the specified size",
+    )
     parser.set_defaults(stdlib=False)
     args = parser.parse_args()
 
@@ -346,8 +810,11 @@ if __name__ == "__main__":
         raise StavesError(f"Unsupported ELIBC: {elibc}")
     build(
         image_spec,
-        config=BuilderConfig(libc=libc),
+        config=BuilderConfig(libc=libc, image_id=args.builder_id),
         stdlib=args.stdlib,
+        rootfs_cache=args.rootfs_cache,
+        distfiles_cache_size=args.distfiles_cache_size,
+        ccache_size=args.ccache_size,
     )
     vdb_metadata_cache_path = Path("/tmp/rootfs") / "var" / "db" / "pkg"
     shutil.rmtree(vdb_metadata_cache_path)
@@ -1,11 +1,15 @@
 """Installs Gentoo portage packages into a specified directory."""
 
+import hashlib
 import io
+import itertools
 import logging
 import os
 import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from pathlib import Path
-from typing import IO, Mapping, MutableMapping, Any, Sequence
+from typing import IO, Mapping, MutableMapping, Any, Optional, Sequence
 
 import click
 import docker
@@ -57,6 +61,32 @@ def cli(log_level: str):
 @click.option(
     "--build-cache", help="The name of the cache volume for the Docker runtime"
 )
+@click.option(
+    "--rootfs-cache",
+    help="The name of the volume caching previous root filesystems. "
+    "Enables incremental updates when packages are only added or upgraded",
+)
+@click.option(
+    "--distfiles-cache",
+    help="The name of the cache volume for source archives. "
+    "Absolute paths are mounted as a directory instead",
+)
+@click.option(
+    "--distfiles-cache-size",
+    type=int,
+    help="Maximum size of the distfiles cache in MiB",
+)
+@click.option(
+    "--ccache",
+    help="The name of the cache volume for ccache. Enables compilation with ccache. "
+    "Absolute paths are mounted as a directory instead",
+)
+@click.option(
+    "--ccache-size",
+    default="5G",
+    show_default=True,
+    help="Maximum size of the ccache cache",
+)
 @click.option(
     "--ssh/--no-ssh",
     is_flag=True,
@@ -91,6 +121,11 @@ def build(
     builder,
     portage,
     build_cache,
+    rootfs_cache,
+    distfiles_cache,
+    distfiles_cache_size,
+    ccache,
+    ccache_size,
     ssh,
     netrc,
     locale,
@@ -98,28 +133,56 @@ def build(
     version,
 ):
     image_spec = _read_image_spec(config)
-    image_path = Path(image_path)
-    if not image_path.exists():
-        run_docker.run(
-            builder,
-            portage,
-            build_cache,
-            image_spec,
-            image_path,
-            stdlib=stdlib,
-            ssh=ssh,
-            netrc=netrc,
-            env={"LANG": locale},
-        )
-    else:
-        click.echo(
-            f"Found existing image tarball at {str(image_path)}. Skipping build."
-        )
+    config.seek(0)
+    variants = _read_matrix(config)
     config.seek(0)
     packaging_config = _read_packaging_config(config)
     packaging_config.version = packaging_config.version or version
-    tag = "{}:{}".format(packaging_config.name, packaging_config.version)
+    image_path = Path(image_path)
+
+    def build_variant(variant: Variant):
+        variant_builder = variant.builder or builder
+        variant_image_path = image_path
+        tag_version = packaging_config.version
+        lineage = packaging_config.name
+        if variant.name:
+            variant_image_path = image_path.with_name(
+                f"{image_path.stem}-{variant.name}{image_path.suffix}"
+            )
+            tag_version = f"{tag_version}-{variant.name}"
+            lineage = f"{lineage}-{variant.name}"
+        if not variant_image_path.exists():
+            run_docker.run(
+                variant_builder,
+                portage,
+                build_cache,
+                _apply_variant(image_spec, variant, builder),
+                variant_image_path,
+                stdlib=stdlib,
+                ssh=ssh,
+                netrc=netrc,
+                env={"LANG": locale},
+                rootfs_cache=rootfs_cache,
+                lineage=lineage,
+                distfiles_cache=distfiles_cache,
+                distfiles_cache_size=distfiles_cache_size,
+                ccache=ccache,
+                ccache_size=ccache_size,
+                label=variant.name or None,
+            )
+        else:
+            click.echo(
+                f"Found existing image tarball at {str(variant_image_path)}. Skipping build."
+            )
+        tag = "{}:{}".format(packaging_config.name, tag_version)
+        _package_image(variant_image_path, tag, packaging_config)
 
+    with ThreadPoolExecutor(max_workers=len(variants)) as executor:
+        for _ in executor.map(build_variant, variants):
+            pass
+
+
+def _package_image(image_path: Path, tag: str, packaging_config: PackagingConfig):
     client = docker.from_env()
     dockerfile = _create_dockerfile(
         packaging_config.annotations, *packaging_config.command
@@ -132,11 +195,68 @@ def build(
         client.images.build(fileobj=context, tag=tag, custom_context=True)
 
 
+@dataclass
+class Variant:
+    name: str = ""
+    builder: Optional[str] = None
+    env: Mapping[str, str] = field(default_factory=dict)
+    use: Sequence[str] = field(default_factory=list)
+
+
+def _read_matrix(config_file: IO) -> Sequence[Variant]:
+    config = toml.load(config_file)
+    matrix = config.get("matrix", {})
+    axes = [
+        [(label, values) for label, values in axis.items()]
+        for axis in matrix.values()
+        if axis
+    ]
+    if not axes:
+        return [Variant()]
+    variants = []
+    for combination in itertools.product(*axes):
+        variant = Variant(name="-".join(label for label, _ in combination))
+        for _, values in combination:
+            if "builder" in values:
+                if variant.builder is not None:
+                    raise StavesError(
+                        f"Matrix variant {variant.name} specifies more than one builder"
+                    )
+                variant.builder = values["builder"]
+            variant.env = {**variant.env, **values.get("env", {})}
+            variant.use = [*variant.use, *values.get("use", [])]
+        variants.append(variant)
+    return variants
+
+
+def _apply_variant(
+    image_spec: ImageSpec, variant: Variant, default_builder: str
+) -> ImageSpec:
+    global_env = {**image_spec.global_env, **variant.env}
+    if variant.use:
+        use_flags = " ".join(variant.use)
+        global_env["USE"] = "{} {}".format(global_env.get("USE", "${USE}"), use_flags)
+    # Portage reuses binary packages with matching USE flags thanks to
+    # binpkg-multi-instance, but it does not consider compiler flags or the libc.
+    # Variants that differ in those get their own PKGDIR inside the build cache.
+    # Portage searches a PKGDIR recursively, so every matrix variant uses a
+    # sibling directory instead of the root of the build cache.
+    builder = variant.builder or default_builder
+    if variant.name:
+        cache_key = hashlib.sha256(
+            repr((builder, sorted(variant.env.items()))).encode()
+        ).hexdigest()[:16]
+        global_env["PKGDIR"] = f"/var/cache/binpkgs/{cache_key}"
+    return replace(image_spec, global_env=Environment(global_env))
+
+
 def _read_image_spec(config_file: IO) -> ImageSpec:
     config = toml.load(config_file)
     env = config.pop("env") if "env" in config else {}
+    config.pop("matrix", None)
     package_configs = {k: v for k, v in config.items() if isinstance(v, dict)}
     packages_to_be_installed = [*config.get("packages", [])]
+    files_to_be_copied = [*config.get("files", [])]
     return ImageSpec(
         global_env=Environment(
             {k: v for k, v in env.items() if not isinstance(v, dict)}
@@ -146,6 +266,7 @@ def _read_image_spec(config_file: IO) -> ImageSpec:
         locale=_parse_locale(config),
         package_configs=package_configs,
         packages_to_be_installed=packages_to_be_installed,
+        files_to_be_copied=files_to_be_copied,
     )
 
 
@@ -7,7 +7,7 @@ import struct
 import tarfile
 from dataclasses import asdict
 from pathlib import Path
-from typing import Mapping
+from typing import Iterable, Mapping
 
 import docker
 from docker.types import Mount
@@ -19,6 +19,28 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+def _cache_mount(source: str, target: str) -> Mount:
+    if os.path.isabs(source):
+        os.makedirs(source, exist_ok=True)
+        return Mount(type="bind", source=source, target=target)
+    return Mount(type="volume", source=source, target=target)
+
+
+def _log_prefix(label: str = None) -> str:
+    return f"[{label}] " if label else ""
+
+
+def _print_logs(chunks: Iterable[bytes], label: str = None):
+    prefix = _log_prefix(label)
+    buffer = b""
+    for chunk in chunks:
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            print(prefix + line.decode(errors="replace"))
+    if buffer:
+        print(prefix + buffer.decode(errors="replace"))
+
+
 def run(
     builder: str,
     portage: str,
@@ -29,6 +51,13 @@ def run(
     ssh: bool = False,
     netrc: bool = False,
     env: Mapping[str, str] = None,
+    rootfs_cache: str = None,
+    lineage: str = None,
+    distfiles_cache: str = None,
+    distfiles_cache_size: int = None,
+    ccache: str = None,
+    ccache_size: str = "5G",
+    label: str = None,
 ):
     docker_client = docker.from_env()
 
@@ -39,6 +68,18 @@ def run(
             target="/var/cache/binpkgs",
         )
     ]
+    if rootfs_cache:
+        mounts.append(
+            Mount(
+                type="volume",
+                source=rootfs_cache,
+                target="/var/cache/staves/rootfs",
+            )
+        )
+    if distfiles_cache:
+        mounts.append(_cache_mount(distfiles_cache, "/var/cache/distfiles"))
+    if ccache:
+        mounts.append(_cache_mount(ccache, "/var/cache/ccache"))
     if ssh:
         ssh_dir = str(Path.home().joinpath(".ssh"))
         mounts += [
@@ -67,7 +108,7 @@ def run(
     for mount in mounts:
         logger.debug(str(mount))
     for log_output in docker_client.api.pull(portage, stream=True, decode=True):
-        print(log_output)
+        print(_log_prefix(label) + str(log_output))
     portage_container = docker_client.containers.create(
         portage,
         auto_remove=True,
@@ -75,6 +116,13 @@ def run(
     args = []
     if stdlib:
         args += ["--stdlib"]
+    if rootfs_cache:
+        builder_id = docker_client.images.get(builder).id
+        args += ["--rootfs-cache", lineage, "--builder-id", builder_id]
+    if distfiles_cache and distfiles_cache_size is not None:
+        args += ["--distfiles-cache-size", str(distfiles_cache_size)]
+    if ccache:
+        args += ["--ccache-size", ccache_size]
     container = docker_client.containers.create(
         builder,
         entrypoint=["/usr/bin/python", "/staves.py"],
@@ -102,6 +150,7 @@ def run(
             repositories=[asdict(repository) for repository in image_spec.repositories],
             package_configs=image_spec.package_configs,
             packages_to_be_installed=image_spec.packages_to_be_installed,
+            files_to_be_copied=image_spec.files_to_be_copied,
         )
     ).encode()
     content_length = struct.pack(">Q", len(serialized_image_spec))
@@ -109,8 +158,7 @@ def run(
     container_input._sock.send(content)
     container_input._sock.shutdown(socket.SHUT_RDWR)
     container_input.close()
-    for line in container.logs(stream=True):
-        print(line.decode(), end="")
+    _print_logs(container.logs(stream=True), label=label)
     container.stop()
     container.wait()
     image_chunks, _ = container.get_archive("/tmp/rootfs")
@@ -1,8 +1,32 @@
+import io
+import logging
 import os
+import subprocess
 
+import pytest
 import toml
 from click.testing import CliRunner
-from staves.cli import cli
+from staves.builders.gentoo import (
+    BuilderConfig,
+    Environment,
+    ImageSpec,
+    Libc,
+    Locale,
+    StavesError,
+    _configure_logging,
+    _copy_to_rootfs,
+    _create_rootfs,
+    _depclean_rootfs,
+    _enable_ccache,
+    _evict_distfiles,
+    _is_incremental_update_safe,
+    _log_ccache_stats,
+    _lock_distfiles,
+    _rootfs_manifest,
+    _stdlib_paths,
+)
+from staves.cli import Variant, _apply_variant, _read_matrix, cli
+from staves.runtimes.docker import _print_logs
 
 
 def test_creates_lib_symlink(tmpdir, monkeypatch, mocker):
@@ -65,3 +89,293 @@ def test_copies_libgcc(tmpdir, monkeypatch, mocker):
 
     assert result.exit_code == 0, result.output
     assert os.path.exists(os.path.join(rootfs_path, "usr", "lib64", "libgcc_s.so.1"))
+
+
+def test_matrix_builds_every_combination_of_axis_values(tmpdir):
+    config_file = tmpdir.join("staves.toml")
+    config_file.write(
+        toml.dumps(
+            dict(
+                matrix=dict(
+                    cpu=dict(baseline={}, avx2=dict(env=dict(CFLAGS="-march=haswell"))),
+                    features=dict(full={}, minimal=dict(use=["-nls"])),
+                )
+            )
+        )
+    )
+
+    with open(str(config_file)) as config:
+        variants = _read_matrix(config)
+
+    assert [variant.name for variant in variants] == [
+        "baseline-full",
+        "baseline-minimal",
+        "avx2-full",
+        "avx2-minimal",
+    ]
+    assert variants[3].env == {"CFLAGS": "-march=haswell"}
+    assert variants[3].use == ["-nls"]
+
+
+def test_matrix_variants_share_binpkgs_unless_build_environment_differs():
+    image_spec = ImageSpec(
+        locale=Locale("C", "UTF-8"), global_env=Environment({"USE": "-X"})
+    )
+
+    baseline = _apply_variant(image_spec, Variant(name="baseline"), "builder")
+    use_variant = _apply_variant(
+        image_spec, Variant(name="minimal", use=["-nls"]), "builder"
+    )
+    env_variant = _apply_variant(
+        image_spec, Variant(name="avx2", env={"CFLAGS": "-O3"}), "builder"
+    )
+
+    assert use_variant.global_env["USE"] == "-X -nls"
+    assert use_variant.global_env["PKGDIR"] == baseline.global_env["PKGDIR"]
+    assert env_variant.global_env["CFLAGS"] == "-O3"
+    assert env_variant.global_env["PKGDIR"] != baseline.global_env["PKGDIR"]
+    assert not env_variant.global_env["PKGDIR"].startswith(
+        baseline.global_env["PKGDIR"] + "/"
+    )
+    assert "PKGDIR" not in _apply_variant(image_spec, Variant(), "builder").global_env
+
+
+def test_prefixes_container_logs_with_variant_label(capsys):
+    _print_logs([b"first li", b"ne\nsecond line\n", b"last"], label="avx2")
+
+    assert capsys.readouterr().out.splitlines() == [
+        "[avx2] first line",
+        "[avx2] second line",
+        "[avx2] last",
+    ]
+
+
+def test_incremental_update_is_only_safe_when_packages_are_added():
+    config = BuilderConfig(libc=Libc.glibc, image_id="sha256:builder")
+    previous = ImageSpec(
+        locale=Locale("C", "UTF-8"), packages_to_be_installed=["app-shells/bash"]
+    )
+    added_package = ImageSpec(
+        locale=Locale("C", "UTF-8"),
+        packages_to_be_installed=["app-shells/bash", "app-misc/jq"],
+    )
+    removed_package = ImageSpec(locale=Locale("C", "UTF-8"))
+    changed_env = ImageSpec(
+        locale=Locale("C", "UTF-8"),
+        global_env=Environment({"CFLAGS": "-O3"}),
+        packages_to_be_installed=["app-shells/bash", "app-misc/jq"],
+    )
+
+    def is_safe(current, current_config=config, stdlib=False):
+        return _is_incremental_update_safe(
+            _rootfs_manifest(previous, config, stdlib=False),
+            _rootfs_manifest(current, current_config, stdlib=stdlib),
+        )
+
+    assert is_safe(added_package)
+    assert not is_safe(removed_package)
+    assert not is_safe(changed_env)
+    assert not is_safe(
+        added_package,
+        current_config=BuilderConfig(libc=Libc.glibc, image_id="sha256:other"),
+    )
+    assert not is_safe(added_package, stdlib=True)
+
+
+def test_incremental_update_is_unsafe_for_manifests_in_other_formats():
+    config = BuilderConfig(libc=Libc.glibc, image_id="sha256:builder")
+    image_spec = ImageSpec(
+        locale=Locale("C", "UTF-8"), packages_to_be_installed=["app-shells/bash"]
+    )
+    manifest = _rootfs_manifest(image_spec, config, stdlib=False)
+    legacy_manifest = {
+        key: value
+        for key, value in manifest.items()
+        if key not in ("builder", "stdlib")
+    }
+    malformed_spec = {**manifest, "image_spec": {"locale": {"lang": "C"}}}
+
+    assert not _is_incremental_update_safe(legacy_manifest, manifest)
+    assert not _is_incremental_update_safe(malformed_spec, manifest)
+    assert not _is_incremental_update_safe(None, manifest)
+
+
+def test_depclean_is_restricted_to_packages_of_image_spec(tmpdir, mocker):
+    world_contents = []
+
+    def emerge(command, **kwargs):
+        world_path = tmpdir.join("var", "lib", "portage", "world")
+        world_contents.append(world_path.read())
+        return subprocess.CompletedProcess(command, 0)
+
+    emerge_call = mocker.patch(
+        "staves.builders.gentoo.subprocess.run", side_effect=emerge
+    )
+
+    _depclean_rootfs(str(tmpdir), "app-shells/bash", "virtual/libc", env={})
+
+    assert "--depclean" in emerge_call.call_args[0][0]
+    assert world_contents == ["app-shells/bash\nvirtual/libc\n"]
+    assert not tmpdir.join("var", "lib", "portage", "world").exists()
+
+
+def test_evicts_least_recently_used_distfiles(tmpdir):
+    for age, name in enumerate(["new.tar.gz", "old.tar.gz", "oldest.tar.gz"]):
+        distfile = tmpdir.join(name)
+        distfile.write("x" * 10)
+        last_used = distfile.mtime() - 3600 * (age + 1)
+        os.utime(str(distfile), (last_used, last_used))
+    tmpdir.join("broken.tar.gz._checksum_failure_.abc").write("x")
+
+    _evict_distfiles(max_size=15, distfiles_path=str(tmpdir))
+
+    distfiles = tmpdir.listdir("*.tar.gz*")
+    assert sorted(path.basename for path in distfiles) == ["new.tar.gz"]
+
+
+def test_copy_to_rootfs_preserves_symlinks_and_hardlinks(tmpdir):
+    host_dir = tmpdir.mkdir("host").mkdir("etc")
+    host_dir.join("config").write("content")
+    os.link(str(host_dir.join("config")), str(host_dir.join("hardlink")))
+    host_dir.join("symlink").mksymlinkto("config")
+    host_dir.mkdir("subdir").join("nested").write("nested")
+    host_file = tmpdir.join("host", "libgcc_s.so.1")
+    host_file.write("library")
+    rootfs = tmpdir.join("rootfs")
+
+    _copy_to_rootfs(
+        str(rootfs),
+        str(host_dir),
+        path_mapping={str(host_file): "/usr/lib/libgcc_s.so.1"},
+    )
+
+    rootfs_dir = rootfs.join(os.path.relpath(str(host_dir), "/"))
+    assert rootfs_dir.join("config").read() == "content"
+    assert (
+        rootfs_dir.join("config").stat().ino == rootfs_dir.join("hardlink").stat().ino
+    )
+    assert rootfs_dir.join("symlink").readlink() == "config"
+    assert rootfs_dir.join("subdir", "nested").read() == "nested"
+    assert rootfs.join("usr", "lib", "libgcc_s.so.1").read() == "library"
+
+
+def test_eviction_keeps_downloads_in_progress(tmpdir):
+    tmpdir.join("fresh.tar.gz.__download__").write("x" * 10)
+    stale_download = tmpdir.join("stale.tar.gz.__download__")
+    stale_download.write("x" * 10)
+    last_modified = stale_download.mtime() - 2 * 24 * 3600
+    os.utime(str(stale_download), (last_modified, last_modified))
+
+    _evict_distfiles(max_size=0, distfiles_path=str(tmpdir))
+
+    assert tmpdir.join("fresh.tar.gz.__download__").exists()
+    assert not stale_download.exists()
+
+
+def test_eviction_is_skipped_while_distfiles_are_in_use(tmpdir):
+    tmpdir.join("distfile.tar.gz").write("x" * 10)
+    concurrent_build_lock = _lock_distfiles(str(tmpdir))
+
+    _evict_distfiles(max_size=0, distfiles_path=str(tmpdir))
+    concurrent_build_lock.close()
+
+    assert tmpdir.join("distfile.tar.gz").exists()
+
+
+def test_enables_ccache_in_build_environment(tmpdir, monkeypatch, mocker):
+    monkeypatch.setenv("CCACHE_DIR", "")
+    monkeypatch.setattr(
+        "staves.builders.gentoo.ccache_stats_log", str(tmpdir.join("stats.log"))
+    )
+    mocker.patch("staves.builders.gentoo.shutil.which", return_value="/usr/bin/ccache")
+    subprocess_run = mocker.patch(
+        "staves.builders.gentoo.subprocess.run",
+        return_value=subprocess.CompletedProcess([], 0),
+    )
+    build_env = mocker.Mock()
+
+    _enable_ccache(build_env, "5G")
+
+    env_vars = build_env.write_env.call_args[0][0]
+    assert "ccache" in env_vars["FEATURES"].split()
+    assert env_vars["CCACHE_DIR"] == "/var/cache/ccache"
+    assert subprocess_run.call_args[0][0] == ["ccache", "--max-size", "5G"]
+
+
+def test_logs_ccache_stats_of_current_build(tmpdir, caplog):
+    caplog.set_level(logging.INFO)
+    stats_log = tmpdir.join("stats.log")
+    stats_log.write(
+        "# a.c\ndirect_cache_hit\n"
+        "# b.c\npreprocessed_cache_hit\n"
+        "# c.c\ncache_miss\n"
+        "# d.c\ndirect_cache_hit\n"
+    )
+
+    _log_ccache_stats(str(stats_log))
+
+    assert "hits: 3, misses: 1, hit rate: 75.0%" in caplog.text
+
+
+def test_copy_to_rootfs_fails_when_glob_matches_nothing(tmpdir):
+    with pytest.raises(StavesError):
+        _copy_to_rootfs(str(tmpdir.join("rootfs")), str(tmpdir.join("missing*")))
+
+
+def test_copy_to_rootfs_handles_overlapping_globs(tmpdir):
+    host_dir = tmpdir.mkdir("host").mkdir("ssl")
+    host_dir.join("openssl.cnf").write("config")
+    rootfs = tmpdir.join("rootfs")
+
+    _copy_to_rootfs(str(rootfs), str(host_dir), str(host_dir.join("openssl.cnf")))
+
+    rootfs_dir = rootfs.join(os.path.relpath(str(host_dir), "/"))
+    assert rootfs_dir.join("openssl.cnf").read() == "config"
+
+
+def test_copies_target_of_symlinked_libstdcpp(tmpdir, mocker):
+    gcc_dir = tmpdir.mkdir("gcc")
+    gcc_dir.join("libgcc_s.so.1").write("libgcc")
+    gcc_dir.join("libstdc++.so.6.0.28").write("libstdc++")
+    gcc_dir.join("libstdc++.so.6").mksymlinkto("libstdc++.so.6.0.28")
+    mocker.patch(
+        "staves.builders.gentoo._find_compiler_runtime",
+        side_effect=lambda library: str(gcc_dir.join(library)),
+    )
+    rootfs = tmpdir.join("rootfs")
+
+    _copy_to_rootfs(str(rootfs), path_mapping=_stdlib_paths(copy_libstdcpp=True))
+
+    libstdcpp = rootfs.join("usr", "lib", "libstdc++.so.6")
+    assert not libstdcpp.islink()
+    assert libstdcpp.read() == "libstdc++"
+
+
+def test_builder_reports_ccache_stats_to_stream(tmpdir):
+    stats_log = tmpdir.join("stats.log")
+    stats_log.write("# a.c\ncache_miss\n")
+    stream = io.StringIO()
+    root_logger = logging.getLogger()
+    previous_level = root_logger.level
+    handler = _configure_logging(stream)
+    try:
+        _log_ccache_stats(str(stats_log))
+    finally:
+        root_logger.removeHandler(handler)
+        root_logger.setLevel(previous_level)
+
+    assert "hits: 0, misses: 1" in stream.getvalue()
+
+
+def test_prefetch_is_terminated_when_installation_fails(mocker):
+    prefetch = mocker.Mock()
+    prefetch.wait.return_value = -15
+    mocker.patch("staves.builders.gentoo._prefetch_distfiles", return_value=prefetch)
+    mocker.patch(
+        "staves.builders.gentoo._install_packages", side_effect=KeyboardInterrupt
+    )
+
+    with pytest.raises(KeyboardInterrupt):
+        _create_rootfs("/tmp/rootfs", "app-shells/bash")
+
+    prefetch.terminate.assert_called_once_with()